@@ -65,6 +65,13 @@ if [ "" == "$(dpkg -s python3-venv | grep installed)" ]; then
     sudo apt-get install -y python3-venv python3.7-venv
 fi
 
+for package in python3-dev pkg-config libdbus-1-dev libglib2.0-dev libgirepository1.0-dev libcairo2-dev; do
+    if [ "" == "$(dpkg -s $package | grep installed)" ]; then
+        echo "${green}Installing $package to build dbus-python and PyGObject...${reset}"
+        sudo apt-get install -y $package
+    fi
+done
+
 echo "${green}Installing requirements with pip...${reset}"
 if [ ! -d $VENV ]; then
     # Create a virtual environment if it doesn't exist.
@@ -1,176 +1,312 @@
 import threading
-import time
-import json
-import pexpect
+import queue
+import orjson
+import dbus
+import dbus.mainloop.glib
 import logging
+from gi.repository import GLib
+
+BLUEZ_SERVICE = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
+OBJECT_MANAGER_IFACE = 'org.freedesktop.DBus.ObjectManager'
+
+TOPIC_DEVICES_DISCOVER = 'bluetooth/answer/devicesDiscover'
+TOPIC_DEVICES_DISCOVERED = 'bluetooth/answer/devicesDiscovered'
+TOPIC_DEVICE_CONNECT = 'bluetooth/answer/deviceConnect'
+TOPIC_DEVICE_DISCONNECT = 'bluetooth/answer/deviceDisconnect'
+TOPIC_DEVICE_REMOVE = 'bluetooth/answer/deviceRemove'
+TOPIC_SITE_INFO = 'bluetooth/answer/siteInfo'
 
 
 class BluetoothHelper:
-    """A wrapper for bluetoothctl utility."""
-    # Based on ReachView code from Egor Fedorov (egor.fedorov@emlid.com)
-
-    def __init__(self):
-        self.process = pexpect.spawnu("bluetoothctl", echo=False, timeout=8)
-
-    def send(self, command, pause=0):
-        self.process.send(f"{command}\n")
-        time.sleep(pause)
-        self.process.expect([r"0;94m", pexpect.TIMEOUT, pexpect.EOF])
-
-    def get_output(self, command):
-        """Run a command in bluetoothctl prompt, return output as a list of lines."""
-        self.send(command)
-        return self.process.before.split("\r\n")
-
-    def start_discover(self):
-        """Start bluetooth scanning process."""
-        self.process.send(f"scan off\n")
-        expects = ["Failed to stop discovery", "Discovery stopped", pexpect.EOF, pexpect.TIMEOUT]
-        self.process.expect(expects, 2)
-        time.sleep(1)
-        self.process.send(f"scan on\n")
-        expects = ["Failed to start discovery", "Discovery started", pexpect.EOF, pexpect.TIMEOUT]
-        res = self.process.expect(expects, 2)
-        return res == 1
+    """A wrapper for the BlueZ D-Bus API."""
+
+    def __init__(self, adapter="hci0"):
+        dbus.mainloop.glib.threads_init()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.bus = dbus.SystemBus()
+        self.adapter_path = f"/org/bluez/{adapter}"
+        self.adapter = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE, self.adapter_path), ADAPTER_IFACE)
+        self.object_manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE, "/"), OBJECT_MANAGER_IFACE)
+
+        self.devices = dict()
+        self.devices_lock = threading.Lock()
+        self.disconnect_watches = dict()
+        self.known_devices = set()
+        self.discovered_devices = set()
+        self.discover_count = None
+        self.discovery_done = threading.Event()
+        self.discover_cancelled = threading.Event()
+        self.bus.add_signal_receiver(self.on_interfaces_added, dbus_interface=OBJECT_MANAGER_IFACE,
+                                     signal_name="InterfacesAdded")
+        self.bus.add_signal_receiver(self.on_interfaces_removed, dbus_interface=OBJECT_MANAGER_IFACE,
+                                     signal_name="InterfacesRemoved")
+        self.bus.add_signal_receiver(self.on_properties_changed, dbus_interface=PROPERTIES_IFACE,
+                                     signal_name="PropertiesChanged", arg0=DEVICE_IFACE, path_keyword="path")
+        # The signals are only dispatched once the main loop runs, so none of them is lost while priming
+        with self.devices_lock:
+            self.devices.update((path, dict(properties)) for path, properties in self.get_managed_devices().items())
+        self.loop = GLib.MainLoop()
+        threading.Thread(target=self.loop.run, daemon=True).start()
+
+    def on_interfaces_added(self, path, interfaces):
+        if DEVICE_IFACE in interfaces and path.startswith(self.adapter_path):
+            with self.devices_lock:
+                self.devices[path] = dict(interfaces[DEVICE_IFACE])
+            self.on_device_discovered(path, interfaces[DEVICE_IFACE])
+
+    def on_interfaces_removed(self, path, interfaces):
+        if DEVICE_IFACE in interfaces and path.startswith(self.adapter_path):
+            with self.devices_lock:
+                self.devices.pop(path, None)
+
+    def on_properties_changed(self, interface, changed, invalidated, path=None):
+        if not path.startswith(self.adapter_path):
+            return
+        with self.devices_lock:
+            properties = self.devices.get(path)
+            if properties is not None:
+                properties.update(changed)
+                for name in invalidated:
+                    properties.pop(name, None)
+        if not changed.get("Connected", True):
+            # A single pop, the worker may unwatch the same device concurrently after a requested disconnect
+            watch = self.disconnect_watches.pop(path, None)
+            if watch:
+                mac_address, callback = watch
+                callback(mac_address)
+
+    def on_device_discovered(self, path, properties):
+        # Cached and paired devices keep advertising, only devices new to this discovery are counted
+        if path in self.known_devices or properties.get("Paired"):
+            return
+        self.discovered_devices.add(path)
+        if self.discover_count and len(self.discovered_devices) >= self.discover_count:
+            self.discovery_done.set()
+
+    def wait_for_devices(self, timeout):
+        """Block until discovery reported enough devices or was cancelled, return False on timeout."""
+        return self.discovery_done.wait(timeout)
+
+    def cancel_discover(self):
+        """Cancel the running discovery and every discovery that starts until clear_cancel_discover is called."""
+        self.discover_cancelled.set()
+        self.discovery_done.set()
+
+    def clear_cancel_discover(self):
+        self.discover_cancelled.clear()
+
+    def watch_disconnect(self, mac_address, callback):
+        """Call callback(mac_address) once the device reports that it is no longer connected."""
+        self.disconnect_watches.setdefault(self.get_device_path(mac_address), (mac_address, callback))
+
+    def unwatch_disconnect(self, mac_address):
+        self.disconnect_watches.pop(self.get_device_path(mac_address), None)
+
+    def get_device_path(self, mac_address):
+        return f"{self.adapter_path}/dev_{mac_address.upper().replace(':', '_')}"
+
+    def get_device_object(self, mac_address):
+        return self.bus.get_object(BLUEZ_SERVICE, self.get_device_path(mac_address))
+
+    def get_managed_devices(self):
+        """Return the Device1 properties of all devices known to the adapter, keyed by object path."""
+        devices = dict()
+        for path, interfaces in self.object_manager.GetManagedObjects().items():
+            properties = interfaces.get(DEVICE_IFACE)
+            if properties and properties.get("Adapter") == self.adapter_path:
+                devices[path] = properties
+        return devices
+
+    def start_discover(self, count=None):
+        """Start bluetooth scanning process, the discovery is done after count new devices were seen."""
+        with self.devices_lock:
+            self.known_devices = set(self.devices)
+        self.discover_count = count
+        self.discovered_devices.clear()
+        self.discovery_done.clear()
+        if self.discover_cancelled.is_set():
+            self.discovery_done.set()
+        # Discovery is tracked per client, a running one may belong to another client and can't be stopped by us
+        try:
+            if self.adapter_property("Discovering"):
+                self.adapter.StopDiscovery()
+        except dbus.exceptions.DBusException as e:
+            logging.debug(f"Failed to stop discovery: {e}")
+        try:
+            self.adapter.StartDiscovery()
+        except dbus.exceptions.DBusException as e:
+            logging.debug(f"Failed to start discovery: {e}")
+            return False
+        return True
+
+    def stop_discover(self):
+        """Stop bluetooth scanning process."""
+        try:
+            self.adapter.StopDiscovery()
+        except dbus.exceptions.DBusException as e:
+            logging.debug(f"Failed to stop discovery: {e}")
+            return False
+        return True
+
+    def adapter_property(self, name):
+        properties = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE, self.adapter_path), PROPERTIES_IFACE)
+        return bool(properties.Get(ADAPTER_IFACE, name))
 
     @staticmethod
-    def parse_device_info(info_string):
-        """Parse a string corresponding to a device."""
-        device = {}
-        block_list = ["[\x1b[0;", "removed"]
-        if not any(keyword in info_string for keyword in block_list):
-            try:
-                device_position = info_string.index("Device")
-            except ValueError:
-                pass
-            else:
-                if device_position > -1:
-                    attribute_list = info_string[device_position:].split(" ", 2)
-                    device = {
-                        "mac_address": attribute_list[1],
-                        "name": attribute_list[2],
-                    }
-        return device
+    def device_info(properties):
+        """Convert Device1 properties into the device dict that is sent over MQTT."""
+        return {
+            "mac_address": str(properties["Address"]),
+            "name": str(properties.get("Alias", properties["Address"])),
+        }
+
+    def snapshot_devices(self):
+        """Return available and paired devices and a mac address lookup.
+
+        The devices are read from the model that the BlueZ signals keep up to date, so no D-Bus call is made.
+        """
+        with self.devices_lock:
+            devices = [dict(properties) for properties in self.devices.values()]
+        by_mac = dict()
+        available_devices = []
+        paired_devices = []
+        for properties in devices:
+            device = self.device_info(properties)
+            paired = bool(properties.get("Paired"))
+            by_mac[device["mac_address"]] = {"name": device["name"], "paired": paired}
+            available_devices.append(device)
+            if paired:
+                paired_devices.append(device)
+        return {"by_mac": by_mac, "available": available_devices, "paired": paired_devices}
 
     def get_available_devices(self):
         """Return a list of tuples of paired and discoverable devices."""
-        available_devices = []
-        out = self.get_output("devices")
-        for line in out:
-            device = self.parse_device_info(line)
-            if device:
-                available_devices.append(device)
-        return available_devices
+        return self.snapshot_devices()["available"]
 
     def get_paired_devices(self):
         """Return a list of tuples of paired devices."""
-        paired_devices = []
-        out = self.get_output("paired-devices")
-        for line in out:
-            device = self.parse_device_info(line)
-            if device:
-                paired_devices.append(device)
-        return paired_devices
+        return self.snapshot_devices()["paired"]
 
-    def get_discoverable_devices(self):
+    def get_discoverable_devices(self, snapshot=None):
         """Filter paired devices out of available."""
-        available = self.get_available_devices()
-        paired = self.get_paired_devices()
-        return [d for d in available if d not in paired]
+        snapshot = snapshot or self.snapshot_devices()
+        by_mac = snapshot["by_mac"]
+        return [d for d in snapshot["available"] if not by_mac[d["mac_address"]]["paired"]]
 
     def get_device_info(self, mac_address):
         """Get device info by mac address."""
-        out = self.get_output(f"info {mac_address}")
-        return out
+        properties = dbus.Interface(self.get_device_object(mac_address), PROPERTIES_IFACE)
+        return properties.GetAll(DEVICE_IFACE)
 
     def remove(self, mac_address):
         """Remove paired device by mac address, return success of the operation."""
-        self.process.send(f"remove {mac_address}\n")
-        res = self.process.expect(["not available", "Device has been removed", pexpect.EOF, pexpect.TIMEOUT], 7)
-        return res == 1
+        device_path = self.get_device_path(mac_address)
+        try:
+            self.adapter.RemoveDevice(device_path, timeout=7)
+        except dbus.exceptions.DBusException as e:
+            logging.debug(f"Failed to remove {mac_address}: {e}")
+            return False
+        # Don't wait for InterfacesRemoved, the answer to this request already contains the device lists
+        with self.devices_lock:
+            self.devices.pop(device_path, None)
+        return True
 
     def connect(self, mac_address):
         """Try to connect to a device by mac address."""
-        self.process.send(f"connect {mac_address}\n")
-        expects = ["Failed to connect", "Connection successful", "not available", pexpect.TIMEOUT, pexpect.EOF]
-        res = self.process.expect(expects, 7)
-        return res == 1
+        try:
+            dbus.Interface(self.get_device_object(mac_address), DEVICE_IFACE).Connect(timeout=7)
+        except dbus.exceptions.DBusException as e:
+            logging.debug(f"Failed to connect to {mac_address}: {e}")
+            return False
+        return True
 
     def is_connected(self, mac_address):
-        self.process.send(f"info {mac_address}\n")
-        expects = ["Connected: no", "Connected: yes", "not available", pexpect.TIMEOUT, pexpect.EOF]
-        res = self.process.expect(expects, 4)
-        self.process.expect([r"0;94m", pexpect.TIMEOUT, pexpect.EOF])
-        return res == 1
+        with self.devices_lock:
+            properties = self.devices.get(self.get_device_path(mac_address), dict())
+            return bool(properties.get("Connected"))
 
     def disconnect(self, mac_address):
         """Try to disconnect to a device by mac address."""
-        self.process.send(f"disconnect {mac_address}\n")
-        expects = ["Failed to disconnect", "not available", "Connected: no",
-                   "Successful disconnected", pexpect.TIMEOUT, pexpect.EOF]
-        res = self.process.expect(expects, 6)
-        return res == 2 or res == 3
+        try:
+            dbus.Interface(self.get_device_object(mac_address), DEVICE_IFACE).Disconnect(timeout=6)
+        except dbus.exceptions.DBusException as e:
+            logging.debug(f"Failed to disconnect from {mac_address}: {e}")
+            return False
+        return True
 
 
 class Bluetooth:
     def __init__(self, mqtt_client, config):
-        self.threadobjs = dict()
-        self.threadobjs_wait_disconnect = dict()
         self.connected_devices = dict()
         self.bl_helper = BluetoothHelper()
         self.mqtt_client = mqtt_client
         self.site_id = config['snips']['site']['site_id']
         self.room_name = config['snips']['site']['room_name']
+        self.site_id_fragment = b',"siteId":' + orjson.dumps(self.site_id) + b'}'
         self.devices_names = [item for item in config['devices'] if not isinstance(config['devices'][item], dict)]
         self.devices_names = {item: config['devices'][item] for item in config['devices']
                               if not isinstance(config['devices'][item], dict)}
+        self.queue = queue.Queue()
+        self.pending_discovers = 0
+        self.discover_lock = threading.Lock()
+        threading.Thread(target=self.thread_worker, daemon=True).start()
         self.fill_connected_devices()
         self.send_blt_info()
 
+    def thread_worker(self):
+        """Run the queued bluetooth operations one after another."""
+        while True:
+            function, args = self.queue.get()
+            try:
+                function(*args)
+            except Exception:
+                logging.exception(f"Bluetooth operation {function.__name__} failed")
+
     def fill_connected_devices(self):
         for d in self.bl_helper.get_paired_devices():
             addr = d['mac_address']
             if self.bl_helper.is_connected(addr):
                 self.connected_devices[addr] = d['name']
-                if addr not in self.threadobjs_wait_disconnect:
-                    thread_obj = threading.Thread(target=self.thread_wait_until_disconnect, args=(addr,))
-                    self.threadobjs_wait_disconnect[addr] = thread_obj
-                    self.threadobjs_wait_disconnect[addr].start()
-            time.sleep(0.2)
-
-    def thread_wait_until_disconnect(self, addr):
-        connected = True
-        while connected:
-            time.sleep(10)
-            if not self.bl_helper.is_connected(addr):
-                connected = False
-            logging.debug(f"({addr}) connected: {connected}")
+                self.bl_helper.watch_disconnect(addr, self.on_device_disconnected)
+
+    def on_device_disconnected(self, addr):
+        # Called from the D-Bus main loop, the cleanup runs on the worker like every other operation
+        logging.debug(f"({addr}) connected: False")
+        self.queue.put((self.thread_device_disconnected, (addr,)))
+
+    def thread_device_disconnected(self, addr):
         if addr in self.connected_devices:
             del self.connected_devices[addr]
             payload = {
-                'siteId': self.site_id,
                 'result': True,
                 'addr': addr
             }
-            self.mqtt_client.publish('bluetooth/answer/deviceDisconnect', payload=json.dumps(payload))
-            self.send_blt_info()
-        if addr in self.threadobjs_wait_disconnect:
-            del self.threadobjs_wait_disconnect[addr]
-
-    def thread_discover(self):
-        result = self.bl_helper.start_discover()
-        payload = {'siteId': self.site_id, 'result': result}
-        self.mqtt_client.publish('bluetooth/answer/devicesDiscover', payload=json.dumps(payload))
-        if not result:
-            return
-        for i in range(30):
-            time.sleep(1)
-        payload = {
-            'discoverable_devices': self.bl_helper.get_discoverable_devices(),
-            'siteId': self.site_id
-        }
-        self.mqtt_client.publish('bluetooth/answer/devicesDiscovered', payload=json.dumps(payload))
-        self.send_blt_info()
+            self.publish_result_with_info(TOPIC_DEVICE_DISCONNECT, payload)
+
+    def thread_discover(self, count=None):
+        try:
+            result = self.bl_helper.start_discover(count)
+            payload = {'siteId': self.site_id, 'result': result}
+            self.mqtt_client.publish(TOPIC_DEVICES_DISCOVER, payload=orjson.dumps(payload))
+            if not result:
+                return
+            self.bl_helper.wait_for_devices(30)
+            self.bl_helper.stop_discover()
+            snapshot = self.bl_helper.snapshot_devices()
+            payload = {
+                'discoverable_devices': self.bl_helper.get_discoverable_devices(snapshot),
+                'siteId': self.site_id
+            }
+            self.mqtt_client.publish(TOPIC_DEVICES_DISCOVERED, payload=orjson.dumps(payload))
+            self.send_blt_info(snapshot)
+        finally:
+            with self.discover_lock:
+                self.pending_discovers -= 1
+                if not self.pending_discovers:
+                    self.bl_helper.clear_cancel_discover()
 
     def thread_connect(self, addr, tries):
 
@@ -181,22 +317,17 @@ class Bluetooth:
                 if result:
                     break
 
+        snapshot = self.bl_helper.snapshot_devices()
         if result:
             if addr not in self.connected_devices:
-                name = [d['name'] for d in self.bl_helper.get_available_devices() if d['mac_address'] == addr][0]
-                self.connected_devices[addr] = name
-            if addr not in self.threadobjs_wait_disconnect:
-                thread_obj = threading.Thread(target=self.thread_wait_until_disconnect, args=(addr,))
-                self.threadobjs_wait_disconnect[addr] = thread_obj
-                self.threadobjs_wait_disconnect[addr].start()
+                self.connected_devices[addr] = snapshot['by_mac'][addr]['name']
+            self.bl_helper.watch_disconnect(addr, self.on_device_disconnected)
 
         payload = {
-            'siteId': self.site_id,
             'result': result,
             'addr': addr
         }
-        self.mqtt_client.publish(f'bluetooth/answer/deviceConnect', payload=json.dumps(payload))
-        self.send_blt_info()
+        self.publish_result_with_info(TOPIC_DEVICE_CONNECT, payload, snapshot)
 
     def thread_disconnect(self, addr):
 
@@ -204,16 +335,13 @@ class Bluetooth:
         if result:
             if addr in self.connected_devices:
                 del self.connected_devices[addr]
-            if addr in self.threadobjs_wait_disconnect:
-                del self.threadobjs_wait_disconnect[addr]
+            self.bl_helper.unwatch_disconnect(addr)
 
         payload = {
-            'siteId': self.site_id,
             'result': result,
             'addr': addr
         }
-        self.mqtt_client.publish('bluetooth/answer/deviceDisconnect', payload=json.dumps(payload))
-        self.send_blt_info()
+        self.publish_result_with_info(TOPIC_DEVICE_DISCONNECT, payload)
 
     def thread_remove(self, addr):
 
@@ -221,61 +349,77 @@ class Bluetooth:
         if result:
             if addr in self.connected_devices:
                 del self.connected_devices[addr]
-            if addr in self.threadobjs_wait_disconnect:
-                del self.threadobjs_wait_disconnect[addr]
+            self.bl_helper.unwatch_disconnect(addr)
 
         payload = {
-            'siteId': self.site_id,
             'result': result,
             'addr': addr
         }
-        self.mqtt_client.publish('bluetooth/answer/deviceRemove', payload=json.dumps(payload))
-        self.send_blt_info()
+        self.publish_result_with_info(TOPIC_DEVICE_REMOVE, payload)
 
     def msg_discover(self, client, userdata, msg):
-        if 'discover' in self.threadobjs:
-            del self.threadobjs['discover']
-        self.threadobjs['discover'] = threading.Thread(target=self.thread_discover)
-        self.threadobjs['discover'].start()
+        count = self.get_discover_count(msg.payload)
+        with self.discover_lock:
+            self.pending_discovers += 1
+        self.queue.put((self.thread_discover, (count,)))
+
+    @staticmethod
+    def get_discover_count(payload):
+        """Read the optional device count of a discover request, a malformed payload means no count."""
+        try:
+            data = orjson.loads(payload) if payload else None
+            if isinstance(data, dict) and data.get('count'):
+                return int(data['count'])
+        except (orjson.JSONDecodeError, ValueError, TypeError):
+            logging.debug(f"Ignoring invalid discover request payload: {payload!r}")
+        return None
+
+    def msg_discover_cancel(self, client, userdata, msg):
+        # Not queued, the worker is busy waiting for the running discovery.
+        # A cancel also covers discoveries that are still queued, without any it is ignored.
+        with self.discover_lock:
+            if self.pending_discovers:
+                self.bl_helper.cancel_discover()
 
     def msg_connect(self, client, userdata, msg):
-        data = json.loads(msg.payload.decode("utf-8"))
+        data = orjson.loads(msg.payload)
         if data.get('tries'):
             self.connect(data['addr'], int(data['tries']))
         else:
             self.connect(data['addr'])
 
     def connect(self, addr, tries=0):
-        if 'connect' in self.threadobjs:
-            del self.threadobjs['connect']
-        self.threadobjs['connect'] = threading.Thread(target=self.thread_connect, args=(addr, tries,))
-        self.threadobjs['connect'].start()
+        # BlueZ reports upper-case addresses, the device lists and connected_devices are keyed by them
+        self.queue.put((self.thread_connect, (addr.upper(), tries)))
 
     def msg_disconnect(self, client, userdata, msg):
-        data = json.loads(msg.payload.decode("utf-8"))
-        if 'disconnect' in self.threadobjs:
-            del self.threadobjs['disconnect']
-        self.threadobjs['disconnect'] = threading.Thread(target=self.thread_disconnect, args=(data['addr'],))
-        self.threadobjs['disconnect'].start()
+        data = orjson.loads(msg.payload)
+        self.queue.put((self.thread_disconnect, (data['addr'].upper(),)))
 
     def msg_remove(self, client, userdata, msg):
-        data = json.loads(msg.payload.decode("utf-8"))
-        if 'remove' in self.threadobjs:
-            del self.threadobjs['remove']
-        self.threadobjs['remove'] = threading.Thread(target=self.thread_remove, args=(data['addr'],))
-        self.threadobjs['remove'].start()
+        data = orjson.loads(msg.payload)
+        self.queue.put((self.thread_remove, (data['addr'].upper(),)))
 
     def msg_send_blt_info(self, client, userdata, msg):
         self.send_blt_info()
 
-    def send_blt_info(self):
-        available_devices = self.bl_helper.get_available_devices()
-        payload = {
+    def get_blt_info(self, snapshot=None):
+        snapshot = snapshot or self.bl_helper.snapshot_devices()
+        available_devices = snapshot['available']
+        return {
             'room_name': self.room_name,
             'site_id': self.site_id,
             'device_names': self.devices_names,
             'available_devices': available_devices,
-            'paired_devices': self.bl_helper.get_paired_devices(),
+            'paired_devices': snapshot['paired'],
             'connected_devices': [d for d in available_devices if d['mac_address'] in self.connected_devices]
         }
-        self.mqtt_client.publish('bluetooth/answer/siteInfo', payload=json.dumps(payload))
+
+    def send_blt_info(self, snapshot=None):
+        self.mqtt_client.publish(TOPIC_SITE_INFO, payload=orjson.dumps(self.get_blt_info(snapshot)))
+
+    def publish_result_with_info(self, topic, payload, snapshot=None):
+        """Publish an operation result together with the site info in a single message."""
+        payload.update(self.get_blt_info(snapshot))
+        # The siteId never changes, so it is appended as pre-encoded fragment in place of the closing brace
+        self.mqtt_client.publish(topic, payload=orjson.dumps(payload)[:-1] + self.site_id_fragment)
@@ -6,11 +6,16 @@ import time
 import logging
 from . import bluetoothctl, squeezelitectl
 
+TOPIC_SITE_INFO = 'squeezebox/answer/siteInfo'
+TOPIC_SERVICE_START = 'squeezebox/answer/serviceStart'
+TOPIC_SERVICE_STOP = 'squeezebox/answer/serviceStop'
+
 
 class FlowControll:
     def __init__(self, mqtt_client, config):
         self.mqtt_client = mqtt_client
         self.config = config
+        self.site_id = self.config['snips']['site']['site_id']
         self.bltctl = bluetoothctl.Bluetooth(self.mqtt_client, self.config)
         self.sqectl = squeezelitectl.SqueezeliteControll()
         self.devices_conf = self.config['devices']
@@ -91,18 +96,18 @@ class FlowControll:
         client = args[0]
         payload = {
             'room_name': self.config['snips']['site']['room_name'],
-            'site_id': self.config['snips']['site']['site_id'],
+            'site_id': self.site_id,
             'area': self.config['snips']['site']['area'],
             'devices': self.get_device_list(),
             'default_device': self.config['squeezelite']['default_device'],
             'auto_pause': self.config['squeezelite']['pause_while_dialogue']
         }
-        client.publish('squeezebox/answer/siteInfo', payload=json.dumps(payload))
+        client.publish(TOPIC_SITE_INFO, payload=json.dumps(payload))
 
     @staticmethod
     def thread_wait_few_seconds(client, payload):
         time.sleep(2)
-        client.publish('squeezebox/answer/serviceStart', payload=json.dumps(payload))
+        client.publish(TOPIC_SERVICE_START, payload=json.dumps(payload))
 
     def msg_service_start(self, *args):
         data = json.loads(args[2].payload.decode("utf-8"))
@@ -117,7 +122,7 @@ class FlowControll:
             timeout,
         )
         payload = {
-            'siteId': self.config['snips']['site']['site_id'],
+            'siteId': self.site_id,
             'result': result
         }
         self.msg_send_site_info(args[0])
@@ -127,8 +132,8 @@ class FlowControll:
         client = args[0]
         result = self.sqectl.service_stop()
         payload = {
-            'siteId': self.config['snips']['site']['site_id'],
+            'siteId': self.site_id,
             'result': result
         }
         self.msg_send_site_info(client)
-        client.publish('squeezebox/answer/serviceStop', payload=json.dumps(payload))
+        client.publish(TOPIC_SERVICE_STOP, payload=json.dumps(payload))
@@ -1,13 +1,21 @@
-import pexpect
+import subprocess
 import logging
 
 
 class SqueezeliteControll:
+    @staticmethod
+    def systemctl(*args, timeout=4):
+        """Run a systemctl command, return whether it exited successfully within the timeout."""
+        try:
+            process = subprocess.run(["systemctl", *args], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                     timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        return process.returncode == 0
+
     @staticmethod
     def is_active():
-        expect_list = [r"active \(running\)", r"inactive \(dead\)", "could not be found", "failed"]
-        result = pexpect.spawnu(f"systemctl status squeezelite-custom").expect(expect_list) == 0
-        return result
+        return SqueezeliteControll.systemctl("is-active", "--quiet", "squeezelite-custom", timeout=30)
 
     @staticmethod
     def write_environment_file(server, squeeze_mac, soundcard, name, timeout):
@@ -23,9 +31,8 @@ class SqueezeliteControll:
 
     def service_start(self, server, squeeze_mac, soundcard, name, timeout):
         self.write_environment_file(server, squeeze_mac, soundcard, name, timeout)
-        expect_list = [r"Failed to start", "could not be found", pexpect.EOF, pexpect.TIMEOUT]
         logging.debug("Trying to start/restart squeezelite...")
-        result = pexpect.spawnu(f"systemctl restart -f squeezelite-custom").expect(expect_list, 4) == 2
+        result = self.systemctl("restart", "-f", "squeezelite-custom")
         if result:
             logging.info(f"Successfully started Squeezelite.")
         else:
@@ -34,13 +41,11 @@ class SqueezeliteControll:
 
     @staticmethod
     def service_stop():
-        expect_list = [r"Failed to stop", "could not be found", pexpect.EOF, pexpect.TIMEOUT]
         logging.debug("Trying to stop squeezelite...")
-        result = pexpect.spawnu(f"systemctl stop -f squeezelite-custom").expect(expect_list, 4) == 2
+        result = SqueezeliteControll.systemctl("stop", "-f", "squeezelite-custom")
         if not result:
             logging.debug("No success, trying to kill squeezelite...")
-            expect_list = [r"Failed to kill", "could not be found", pexpect.EOF, pexpect.TIMEOUT]
-            result = pexpect.spawnu(f"systemctl kill squeezelite-custom").expect(expect_list, 4) == 2
+            result = SqueezeliteControll.systemctl("kill", "squeezelite-custom")
         if result:
             logging.info(f"Successfully stopped Squeezelite.")
         else: